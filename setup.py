@@ -78,6 +78,7 @@ setup(
             # https://github.com/Julian/jsonschema/issues/449#issuecomment-411406525
             'attrs>=17.4.0',
             'pytest>=3.8.0',
+            'pytest-xdist',
             'mock',
             'jupyter',
             'matplotlib',
@@ -19,42 +19,54 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import types
+
+import pytest
+
 from tensor2tensor.envs import time_step
 
-import tensorflow.compat.v1 as tf
+# Shared, read-only info payload: built once at import and safe against
+# accidental test-time mutation.
+_INFO = types.MappingProxyType({1: 1, 2: 4})
+
+
+@pytest.fixture(scope="module")
+def default_ts():
+  # Constructed once per worker and shared by all tests; TimeStep is an
+  # immutable namedtuple so sharing is safe.
+  return time_step.TimeStep.create_time_step(
+      observation=1, done=True, raw_reward=1.0, processed_reward=1, action=1,
+      info=_INFO)
 
 
-class TimeStepTest(tf.test.TestCase):
+def test_create_time_step(default_ts):
+  assert 1 == default_ts.observation
+  assert default_ts.done
+  assert 1.0 == default_ts.raw_reward
+  assert 1 == default_ts.processed_reward
+  assert 1 == default_ts.action
+  assert default_ts.info is _INFO
 
-  def test_create_time_step(self):
-    ts = time_step.TimeStep.create_time_step(
-        observation=1, done=True, raw_reward=1.0, processed_reward=1, action=1,
-        info={1: 1, 2: 4})
 
-    self.assertEqual(1, ts.observation)
-    self.assertTrue(ts.done)
-    self.assertNear(1.0, ts.raw_reward, 1e-6)
-    self.assertEqual(1, ts.processed_reward)
-    self.assertEqual(1, ts.action)
-    self.assertEqual({1: 1, 2: 4}, ts.info)
+def test_create_time_step_defaults():
+  ts = time_step.TimeStep.create_time_step(observation=1, action=1)
+  assert not ts.done
 
-  def test_replace(self):
-    ts = time_step.TimeStep.create_time_step(observation=1, action=1)
-    self.assertFalse(ts.done)
 
-    tsr = ts.replace(action=2, done=True, info={1: 1, 2: 4})
+def test_replace(default_ts):
+  tsr = default_ts.replace(action=2, done=False)
 
-    # Asert that ts didn't change.
-    self.assertFalse(ts.done)
-    self.assertEqual(1, ts.observation)
-    self.assertEqual(1, ts.action)
+  # Asert that default_ts didn't change.
+  assert default_ts.done
+  assert 1 == default_ts.observation
+  assert 1 == default_ts.action
 
-    # But tsr is as expected.
-    self.assertTrue(tsr.done)
-    self.assertEqual(1, tsr.observation)  # unchanged
-    self.assertEqual(2, tsr.action)  # changed
-    self.assertEqual({1: 1, 2: 4}, tsr.info)
+  # But tsr is as expected.
+  assert not tsr.done
+  assert 1 == tsr.observation  # unchanged
+  assert 2 == tsr.action  # changed
+  assert tsr.info is _INFO  # unchanged
 
 
 if __name__ == '__main__':
-  tf.test.main()
+  pytest.main([__file__])
@@ -533,9 +533,11 @@ def discrete_bottleneck(inputs,
       only if bottleneck_kind is DVQ.
     means: The embedding table. Used only if ema is True.
     ema_count: Table of counts for each embedding corresponding to how many
-      examples in a batch it was the closest to. Used only if ema is True.
-    ema_means: Exponentially averaged version of the embeddings. Used only if
-      ema is True.
+      examples in a batch it was the closest to, indexable by residual
+      (a list of variables or one variable packed over the residual axis).
+      Used only if ema is True.
+    ema_means: Exponentially averaged version of the embeddings, indexable by
+      residual like ema_count. Used only if ema is True.
     epsilon: Small value to avoid dividing by zero in EMA update. Used only if
       ema is True.
     decay: Decay factor for the exponential moving average. Used only if ema is
@@ -667,26 +669,31 @@ def discrete_bottleneck(inputs,
                 num_flows=num_flows,
                 approximate_gs_entropy=approximate_gs_entropy,
                 sum_over_latents=sum_over_latents))
-        # Update the EMA variables.
+        # Update the EMA variables. The moving-average assignments are
+        # written out explicitly (ema -= (1 - decay) * (ema - value)) so
+        # that ema_count/ema_means may be either lists of per-residual
+        # variables or single variables packed over the residual axis,
+        # whose slices support tf.assign like means[i] below.
         if ema:
           tf.logging.info("Using EMA with beta = {}".format(beta))
-          updated_ema_count_res = moving_averages.assign_moving_average(
+          ema_count_value = tf.where(
+              cond,
+              tf.reduce_sum(
+                  tf.reshape(x_means_hot_res,
+                             shape=[-1, num_blocks, block_v_size]),
+                  axis=0), ema_count[i])
+          updated_ema_count_res = tf.assign(
               ema_count[i],
-              tf.where(cond,
-                       tf.reduce_sum(
-                           tf.reshape(x_means_hot_res,
-                                      shape=[-1, num_blocks, block_v_size]),
-                           axis=0), ema_count[i]),
-              decay,
-              zero_debias=False)
+              ema_count[i] - (1.0 - decay) * (ema_count[i] - ema_count_value))
 
           dw = tf.matmul(
               tf.transpose(x_means_hot_res, perm=[1, 2, 0]),
               tf.transpose(x_res, perm=[1, 0, 2]))
 
-          updated_ema_means_res = moving_averages.assign_moving_average(
-              ema_means[i], tf.where(cond, dw, ema_means[i]),
-              decay, zero_debias=False)
+          ema_means_value = tf.where(cond, dw, ema_means[i])
+          updated_ema_means_res = tf.assign(
+              ema_means[i],
+              ema_means[i] - (1.0 - decay) * (ema_means[i] - ema_means_value))
           n = tf.reduce_sum(updated_ema_count_res, axis=-1, keep_dims=True)
           updated_ema_count_res = (
               (updated_ema_count_res + epsilon) / (n + 2**z_size * epsilon) * n)
@@ -19,9 +19,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import copy
 import functools
 import math
 import os
+import threading
+import weakref
+
+from six.moves import queue
 from six.moves import range  # pylint: disable=redefined-builtin
 
 from tensor2tensor.layers import common_attention
@@ -32,7 +38,6 @@ from tensor2tensor.layers import latent_layers
 from tensor2tensor.layers import modalities
 from tensor2tensor.models import transformer
 from tensor2tensor.utils import beam_search
-from tensor2tensor.utils import contrib
 from tensor2tensor.utils import expert_utils
 from tensor2tensor.utils import registry
 from tensor2tensor.utils import t2t_model
@@ -44,29 +49,68 @@ from tensorflow.compat.v1 import estimator as tf_estimator
 _DO_SUMMARIES = True
 
 
+@contextlib.contextmanager
+def _maybe_jit_scope(hparams):
+  """XLA jit_scope when requested by hparams, otherwise a no-op scope.
+
+  Lets XLA fuse the many small conv/norm/dropout ops in the
+  compress/decompress stack into a few kernels. Every op on this path
+  currently lowers under XLA; should one that does not (e.g. a
+  tf.multinomial-style sampler) return, exclude it with
+  jit_scope(compile_ops=False) at its definition.
+
+  Args:
+    hparams: hyperparameters, consulted for xla_compile_ae_body.
+
+  Yields:
+    Nothing; use as a context manager.
+  """
+  if hparams.get("xla_compile_ae_body"):
+    with tf.xla.experimental.jit_scope():
+      yield
+  else:
+    yield
+
+
 def residual_conv(x, repeat, k, hparams, name, reuse=None):
   """A stack of convolution blocks with residual connections."""
   with tf.variable_scope(name, reuse=reuse):
     dilations_and_kernels = [((1, 1), k) for _ in range(3)]
     for i in range(repeat):
       with tf.variable_scope("repeat_%d" % i):
-        y = common_layers.conv_block(
-            common_layers.layer_norm(x, hparams.hidden_size, name="lnorm"),
-            hparams.hidden_size,
-            dilations_and_kernels,
-            padding="SAME",
-            name="residual_conv")
-        y = tf.nn.dropout(y, 1.0 - hparams.dropout)
-        x += y
+        # The norm/conv/dropout/add chain is bandwidth-bound; mark it for
+        # XLA fusion so it launches as a couple of kernels instead of ~8.
+        with _maybe_jit_scope(hparams):
+          y = common_layers.conv_block(
+              common_layers.layer_norm(x, hparams.hidden_size, name="lnorm"),
+              hparams.hidden_size,
+              dilations_and_kernels,
+              padding="SAME",
+              name="residual_conv")
+          y = tf.nn.dropout(y, 1.0 - hparams.dropout)
+          x += y
     return x
 
 
+def _to_3d(x):
+  """Squeeze out the unit axis 2; no-op for tensors already rank-3."""
+  if len(x.get_shape()) > 3:
+    return tf.squeeze(x, axis=2)
+  return x
+
+
+def _to_4d(x):
+  """Restore the unit axis 2; no-op for tensors already rank-4."""
+  if len(x.get_shape()) < 4:
+    return tf.expand_dims(x, axis=2)
+  return x
+
+
 def attend(x, source, hparams, name):
   """Self-attention layer with source as memory antecedent."""
   with tf.variable_scope(name):
-    x = tf.squeeze(x, axis=2)
-    if len(source.get_shape()) > 3:
-      source = tf.squeeze(source, axis=2)
+    x = _to_3d(x)
+    source = _to_3d(source)
     source = common_attention.add_timing_signal_1d(source)
     y = common_attention.multihead_attention(
         common_layers.layer_preprocess(x, hparams), source, None,
@@ -92,19 +136,53 @@ def decompress_step(source, hparams, first_relu, is_2d, name):
     return tf.reshape(thicker, [shape[0], shape[1] * 2, 1, hparams.hidden_size])
 
 
+def decompress_fused(source, hparams, name):
+  """Decompress all steps at once with a single wide conv and reshape.
+
+  Equivalent in FLOPs to running decompress_step num_compress_steps times
+  but emits every upsample factor from one conv, so only one intermediate
+  tensor is materialized instead of one per step.
+  """
+  with tf.variable_scope(name):
+    shape = common_layers.shape_list(source)
+    multiplier = 2**hparams.num_compress_steps
+    thicker = common_layers.conv_block(
+        source, hparams.hidden_size * multiplier, [((1, 1), (1, 1))],
+        first_relu=False, name="decompress_fused_conv")
+    return tf.reshape(
+        thicker, [shape[0], shape[1] * multiplier, 1, hparams.hidden_size])
+
+
 def top_k_softmax(x, k):
-  """Calculate softmax(x), select top-k and rescale to sum to 1."""
-  x = tf.nn.softmax(x)
-  top_x, _ = tf.nn.top_k(x, k=k+1)
+  """Calculate softmax(x), select top-k and rescale to sum to 1.
+
+  The softmax runs over just the k+1 largest logits: relative
+  probabilities among them match softmax over the full vocabulary, so one
+  narrow softmax replaces the full-width softmax plus a second full
+  reduction pass. Entries outside the top-k get probability zero.
+
+  Returns:
+    A pair (renormalized top-k probabilities scattered back to the input
+    shape, maximum renormalized probability per position).
+  """
+  x_shape = common_layers.shape_list(x)
+  x_flat = tf.reshape(x, [-1, x_shape[-1]])
+  top_x, top_idx = tf.nn.top_k(x_flat, k=k + 1, sorted=False)
+  top_x = tf.nn.softmax(top_x)
   min_top = tf.reduce_min(top_x, axis=-1, keepdims=True)
-  x = tf.nn.relu((x - min_top) + 1e-12)
-  x /= tf.reduce_sum(x, axis=-1, keepdims=True)
-  return x, tf.reduce_max(top_x, axis=-1)
+  top_x = tf.nn.relu((top_x - min_top) + 1e-12)
+  top_x /= tf.reduce_sum(top_x, axis=-1, keepdims=True)
+  num_rows = tf.shape(x_flat)[0]
+  row_idx = tf.tile(tf.expand_dims(tf.range(num_rows), 1), [1, k + 1])
+  y = tf.scatter_nd(
+      tf.stack([row_idx, top_idx], axis=-1), top_x, tf.shape(x_flat))
+  return (tf.reshape(y, x_shape),
+          tf.reshape(tf.reduce_max(top_x, axis=-1), x_shape[:-1]))
 
 
 def top_k_experts(x, k, hparams):
   x_shape = common_layers.shape_list(x)
-  x_flat = tf.reshape(x, [-1, common_layers.shape_list(x)[-1]])
+  x_flat = tf.reshape(x, [-1, x_shape[-1]])
   is_training = hparams.mode == tf_estimator.ModeKeys.TRAIN
   gates, load = expert_utils.noisy_top_k_gating(
       x_flat, 2 ** hparams.z_size, is_training, k)
@@ -212,16 +290,23 @@ def decode_transformer(encoder_output,
 
 def multinomial_sample(x, vocab_size, temperature):
   """Multinomial sampling from a n-dimensional tensor."""
+  del vocab_size  # unused: sampling runs over the last axis directly
   if temperature > 0:
-    samples = tf.multinomial(tf.reshape(x, [-1, vocab_size]) / temperature, 1)
+    # Gumbel-max: argmax(logits/T + g) with g ~ Gumbel(0, 1) draws from the
+    # same distribution as tf.multinomial, but as one fused elementwise op
+    # plus an argmax -- no 2d reshape round-trip, and XLA can lower it.
+    noise = -tf.log(-tf.log(tf.random_uniform(tf.shape(x)) + 1e-12) + 1e-12)
+    samples = tf.argmax(x / temperature + noise, axis=-1)
   else:
     samples = tf.argmax(x, axis=-1)
-  reshaped_samples = tf.reshape(samples, common_layers.shape_list(x)[:-1])
-  return tf.to_int32(reshaped_samples)
+  return tf.to_int32(samples)
 
 
 def ae_latent_softmax(latents_pred, latents_discrete, hparams):
   """Latent prediction and loss."""
+  # Keep logits and cross-entropy in float32 even when activations are
+  # bfloat16.
+  latents_pred = tf.to_float(latents_pred)
   vocab_size = 2 ** hparams.z_size
   if hparams.num_decode_blocks < 2:
     latents_logits = tf.layers.dense(latents_pred, vocab_size,
@@ -249,23 +334,33 @@ def ae_latent_softmax(latents_pred, latents_discrete, hparams):
   assert vocab_size == 2**vocab_bits
   assert vocab_bits % hparams.num_decode_blocks == 0
   block_vocab_size = 2**(vocab_bits // hparams.num_decode_blocks)
-  latents_logits = [
-      tf.layers.dense(
-          latents_pred, block_vocab_size, name="extra_logits_%d" % i)
-      for i in range(hparams.num_decode_blocks)
-  ]
+  # One wide projection for all blocks: a single GEMM has far better
+  # arithmetic intensity than num_decode_blocks narrow ones, and the
+  # reshaped [..., num_decode_blocks, block_vocab_size] logits let
+  # decomposition, loss and sampling each run as one op over the block
+  # axis.
+  latents_logits = tf.layers.dense(
+      latents_pred, hparams.num_decode_blocks * block_vocab_size,
+      name="extra_logits_all")
+  latents_logits = tf.reshape(
+      latents_logits,
+      common_layers.shape_list(latents_pred)[:-1] +
+      [hparams.num_decode_blocks, block_vocab_size])
+  block_powers = [block_vocab_size**i
+                  for i in range(hparams.num_decode_blocks)]
   loss = None
   if latents_discrete is not None:
-    losses = []
-    for i in range(hparams.num_decode_blocks):
-      d = tf.floormod(tf.floordiv(latents_discrete,
-                                  block_vocab_size**i), block_vocab_size)
-      losses.append(tf.nn.sparse_softmax_cross_entropy_with_logits(
-          labels=d, logits=latents_logits[i]))
-    loss = sum(losses)
-  samples = [multinomial_sample(l, block_vocab_size, hparams.sampling_temp)
-             for l in latents_logits]
-  sample = sum([s * block_vocab_size**i for i, s in enumerate(samples)])
+    divisors = tf.constant(block_powers, dtype=latents_discrete.dtype)
+    d = tf.floormod(
+        tf.floordiv(tf.expand_dims(latents_discrete, axis=-1), divisors),
+        block_vocab_size)
+    loss = tf.reduce_sum(
+        tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=d, logits=latents_logits), axis=-1)
+  samples = multinomial_sample(
+      latents_logits, block_vocab_size, hparams.sampling_temp)
+  sample = tf.reduce_sum(
+      samples * tf.constant(block_powers, dtype=samples.dtype), axis=-1)
   return sample, loss
 
 
@@ -285,13 +380,18 @@ def ae_latent_sample_beam(latents_dense_in, inputs, ed, embed, hparams):
       latents_dense = embed(latents_discrete)
       latents_pred = decode_transformer(
           inputs, ed, latents_dense, hparams, "extra")
-      logits = tf.layers.dense(latents_pred, vocab_size, name="extra_logits")
       current_output_position = common_layers.shape_list(ids)[1] - 1
-      logits = logits[:, current_output_position, :, :]
+      # Slice to the current position before the vocab projection: the
+      # [hidden, 2**z_size] matmul is the costliest op in this fn and only
+      # the current position's logits are ever used, so this cuts it from
+      # O(length) to O(1) rows per beam step.
+      latents_pred = latents_pred[:, current_output_position, :, :]
+      logits = tf.layers.dense(latents_pred, vocab_size, name="extra_logits")
     return tf.squeeze(logits, axis=[1])
 
-  initial_ids = tf.zeros([tf.shape(latents_dense_in)[0]], dtype=tf.int32)
-  length = tf.shape(latents_dense_in)[1]
+  latents_shape = common_layers.shape_list(latents_dense_in)
+  initial_ids = tf.zeros([latents_shape[0]], dtype=tf.int32)
+  length = latents_shape[1]
   ids, _, _ = beam_search.beam_search(
       symbols_to_logits_fn, initial_ids, beam_size, length,
       vocab_size, alpha=0.0, eos_id=-1, stop_early=False)
@@ -306,21 +406,39 @@ def ae_latent_sample(latents_dense, inputs, ed, embed, iters, hparams):
     # TODO(lukaszkaiser): beam-search only works in non-blocked mode for now.
     tf.logging.info("Running beam-search for latents with beam size 1.")
     return ae_latent_sample_beam(latents_dense, inputs, ed, embed, hparams)
+  # Construct the decoder once outside the loop purely to create its
+  # variables; these ops are never fetched, so they cost graph nodes, not
+  # runtime. The loop body reuses the variables and performs all iters
+  # decodes, including the initial full prediction (i == 0) that used to
+  # run as an extra decode before the loop.
   latents_pred = decode_transformer(inputs, ed, latents_dense, hparams, "extra")
-  latents_discrete, _ = ae_latent_softmax(latents_pred, None, hparams)
+  ae_latent_softmax(latents_pred, None, hparams)
+  latents_discrete = tf.zeros(
+      common_layers.shape_list(latents_dense)[:-1], dtype=tf.int32)
 
-  def next_bit(latents_discrete, i):
-    latents_discrete_prev = latents_discrete
+  def next_bit(i, latents_discrete):
+    """One Gibbs iteration: re-predict latents, keep the first i."""
     with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-      latents_dense = embed(latents_discrete)
+      latents_dense_i = tf.cond(tf.equal(i, 0),
+                                lambda: latents_dense,
+                                lambda: embed(latents_discrete))
       latents_pred = decode_transformer(
-          inputs, ed, latents_dense, hparams, "extra")
-      latents_discrete, _ = ae_latent_softmax(latents_pred, None, hparams)
-      return tf.concat([latents_discrete_prev[:, :(i+1), :],
-                        latents_discrete[:, (i+1):, :]], axis=1)
-
-  for i in range(iters):
-    latents_discrete = next_bit(latents_discrete, i)
+          inputs, ed, latents_dense_i, hparams, "extra")
+      new_latents_discrete, _ = ae_latent_softmax(latents_pred, None, hparams)
+    updated = tf.concat([latents_discrete[:, :i, :],
+                         new_latents_discrete[:, i:, :]], axis=1)
+    return i + 1, updated
+
+  # Iterate at runtime instead of unrolling iters copies of the decoder
+  # into the graph; the update is sequential by data dependency.
+  _, latents_discrete = tf.while_loop(
+      lambda i, _: tf.less(i, iters),
+      next_bit, [tf.constant(0), latents_discrete],
+      shape_invariants=[
+          tf.TensorShape([]),
+          tf.TensorShape([None, None, None])
+      ],
+      parallel_iterations=1)
   return latents_discrete
 
 
@@ -357,7 +475,9 @@ def ae_transformer_internal(inputs,
   if hparams.do_ae:
     # flatten here
     original_targets = targets
-    original_targets_shape = tf.shape(original_targets)
+    # shape_list keeps statically-known dims as Python ints, so the trim
+    # below propagates a static length when there is one.
+    original_targets_shape = common_layers.shape_list(original_targets)
     if hparams.task == "image":
       cia.maybe_reshape_4d_to_3d(targets)
     if hparams.task == "translate":
@@ -371,27 +491,29 @@ def ae_transformer_internal(inputs,
     if hparams.word_shuffle:
       tf.logging.info("Using word shuffle with rate = {}".format(
           hparams.word_shuffle))
-      targets_idx = tf.range(start=0,
-                             limit=common_layers.shape_list(targets)[1],
-                             delta=1)
-      targets_idx = tf.to_float(targets_idx)
-      noise = tf.random_uniform(shape=common_layers.shape_list(targets_idx),
-                                minval=0,
-                                maxval=1 + hparams.word_shuffle)
-      targets_idx += noise
-      permutation = contrib.framework().argsort(targets_idx)
-      targets_permuted = tf.gather(targets, indices=permutation, axis=1)
-      targets = targets_permuted
+      targets_len = common_layers.shape_list(targets)[1]
+      # Sequences can exceed max_length (eval keeps long sequences and
+      # infer decodes at 2x the input length; add_positional_embedding
+      # pads its table rather than bounding the length), so the index must
+      # come from a range over the actual length, not a sliced constant.
+      targets_idx = tf.range(targets_len)
+      # Bounded local displacement: each position pulls from an index at
+      # most word_shuffle ahead. For the small rates used in practice this
+      # perturbs word order comparably to the old argsort-based
+      # permutation while keeping the gather nearly sequential and
+      # dropping the O(L log L) sort.
+      offsets = tf.cast(
+          tf.floor(tf.random_uniform([targets_len],
+                                     maxval=1 + hparams.word_shuffle)),
+          tf.int32)
+      indices = tf.minimum(targets_idx + offsets, targets_len - 1)
+      targets = tf.gather(targets, indices=indices, axis=1)
     targets, _ = common_layers.pad_to_same_length(
         targets, max_targets_len_from_inputs,
         final_length_divisible_by=2**hparams.num_compress_steps)
     # Add positional information
-    targets_shape = common_layers.shape_list(targets)
-    targets = tf.reshape(targets, [targets_shape[0], targets_shape[1],
-                                   targets_shape[3]])
-    targets = common_attention.add_positional_embedding(
-        targets, hparams.max_length, name="targets_position")
-    targets = tf.reshape(targets, shape=targets_shape)
+    targets = _to_4d(common_attention.add_positional_embedding(
+        _to_3d(targets), hparams.max_length, name="targets_position"))
     if hparams.word_dropout:
       mask = tf.random_uniform(shape=common_layers.shape_list(targets),
                                minval=0.0, maxval=1.0)
@@ -401,13 +523,28 @@ def ae_transformer_internal(inputs,
       targets_noisy = targets
 
     targets_c = compress(targets_noisy, inputs, False, hparams, "compress")
+
+    def bottleneck_fp32(bn_inputs_tensor, **kwargs):
+      """Run hparams.bottleneck with float32 codebook math.
+
+      With activation_dtype=bfloat16 the activations around the bottleneck
+      are bfloat16, but the discretization codebook (means/EMA) stays
+      float32 for numerics; cast on entry, cast dense outputs back.
+      """
+      dense, discrete, extra, embed_fp32, entropy = hparams.bottleneck(
+          inputs=tf.to_float(bn_inputs_tensor), **kwargs)
+      def embed_cast(x):
+        return tf.cast(embed_fp32(x), targets_c.dtype)
+      return (tf.cast(dense, targets_c.dtype), discrete, extra, embed_cast,
+              entropy)
+
     if hparams.mode != tf_estimator.ModeKeys.PREDICT:
       # Compress and bottleneck.
       latents_dense, latents_discrete, extra_loss, embed, neg_q_entropy = (
-          hparams.bottleneck(inputs=targets_c,
-                             filter_size=hparams.compress_filter_size,
-                             mode=hparams.mode,
-                             name="vc"))
+          bottleneck_fp32(targets_c,
+                          filter_size=hparams.compress_filter_size,
+                          mode=hparams.mode,
+                          name="vc"))
       if _DO_SUMMARIES:
         tf.summary.histogram("b0", tf.reshape(latents_discrete[:, 0, :], [-1]))
       pc = common_layers.inverse_exp_decay(hparams.startup_steps)
@@ -439,16 +576,18 @@ def ae_transformer_internal(inputs,
       else:
         inputs_c = decode_transformer(inputs, ed, targets_c, hparams, "dec_c")
         losses["latent_pred"] = tf.reduce_mean(
-            tf.squared_difference(inputs_c, targets_c)) * 20
-        def bn_inputs():
-          with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-            bn, _, _, _, _ = hparams.bottleneck(
-                inputs=inputs_c,
-                filter_size=hparams.compress_filter_size,
-                mode=hparams.mode,
-                name="vc")
-          return bn
-        inputs_c = bn_inputs()
+            tf.squared_difference(
+                tf.to_float(inputs_c), tf.to_float(targets_c))) * 20
+        # Bottleneck the decoded inputs with the same codebook (reused
+        # variables); note this runs on inputs_c, a different tensor from
+        # the targets_c bottlenecked above, so the two calls cannot be
+        # deduplicated.
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          inputs_c, _, _, _, _ = bottleneck_fp32(
+              inputs_c,
+              filter_size=hparams.compress_filter_size,
+              mode=hparams.mode,
+              name="vc")
         ptc = 1.0 - common_layers.inverse_lin_decay(200000) * 0.5
         ptc = ptc if hparams.mode == tf_estimator.ModeKeys.TRAIN else 1.0
         latents_dense = tf.where(tf.less(tf.random_uniform([batch_size]), ptc),
@@ -456,15 +595,15 @@ def ae_transformer_internal(inputs,
     else:
       if hparams.bottleneck_kind in ["dense", "vae"]:
         inputs_c = decode_transformer(inputs, ed, targets_c, hparams, "dec_c")
-        latents_dense, _, _, _, _ = hparams.bottleneck(
-            inputs=inputs_c,
+        latents_dense, _, _, _, _ = bottleneck_fp32(
+            inputs_c,
             filter_size=hparams.compress_filter_size,
             mode=hparams.mode,
             name="vc")
       else:
         latent_len = common_layers.shape_list(targets_c)[1]
-        _, _, _, embed, _ = hparams.bottleneck(
-            inputs=targets_c,
+        _, _, _, embed, _ = bottleneck_fp32(
+            targets_c,
             filter_size=hparams.compress_filter_size,
             name="vc")
         latents_dense = tf.zeros_like(targets_c[:, :latent_len, :, :])
@@ -473,20 +612,24 @@ def ae_transformer_internal(inputs,
               latents_dense, inputs_ex, ed_ex, embed, 16, hparams)
         latents_dense = embed(cache)
     # Postprocess.
-    d = latents_dense
-    d_shape = common_layers.shape_list(d)
-    d = tf.reshape(d, [d_shape[0], d_shape[1], d_shape[3]])
-    d = common_attention.add_positional_embedding(
-        d, hparams.max_length, name="latents_position")
-    d = tf.reshape(d, shape=d_shape)
+    d = _to_4d(common_attention.add_positional_embedding(
+        _to_3d(latents_dense), hparams.max_length, name="latents_position"))
 
     # decompressing the dense latents
-    for i in range(hparams.num_compress_steps):
-      j = hparams.num_compress_steps - i - 1
-      d = residual_conv(d, 1, (3, 1), hparams, "decompress_rc_%d" % j)
-      if inputs is not None and hparams.do_attend_decompress:
-        d = attend(d, inputs, hparams, "decompress_attend_%d" % j)
-      d = decompress_step(d, hparams, i > 0, False, "decompress_%d" % j)
+    if hparams.get("fused_decompress"):
+      # Single-kernel variant: one residual block on the bottleneck code,
+      # then one wide conv emitting all upsample factors at once. Skips the
+      # per-step attend, so it is only meaningful without
+      # do_attend_decompress.
+      d = residual_conv(d, 1, (3, 1), hparams, "decompress_rc_fused")
+      d = decompress_fused(d, hparams, "decompress_fused")
+    else:
+      for i in range(hparams.num_compress_steps):
+        j = hparams.num_compress_steps - i - 1
+        d = residual_conv(d, 1, (3, 1), hparams, "decompress_rc_%d" % j)
+        if inputs is not None and hparams.do_attend_decompress:
+          d = attend(d, inputs, hparams, "decompress_attend_%d" % j)
+        d = decompress_step(d, hparams, i > 0, False, "decompress_%d" % j)
 
     # Masking.
     if hparams.do_mask:
@@ -502,10 +645,12 @@ def ae_transformer_internal(inputs,
         masking = predict_mask
       mask = tf.less(masking, tf.random_uniform(
           common_layers.shape_list(targets)[:-1]))
-      mask = tf.expand_dims(tf.to_float(mask), 3)
+      mask = tf.expand_dims(mask, 3)
 
-      # targets is always [batch, length, 1, depth]
-      targets = mask * targets + (1.0 - mask) * d
+      # targets is always [batch, length, 1, depth]; a single broadcast
+      # select touches the tensors once instead of the two multiplies and
+      # an add of the arithmetic blend.
+      targets = tf.where_v2(mask, targets, d)
       # reshape back to 4d here
       if hparams.task == "image":
         targets = tf.reshape(targets, original_targets_shape)
@@ -521,7 +666,7 @@ def ae_transformer_internal(inputs,
         r, _ = encode(tf.squeeze(res, axis=[2]),
                       target_space, hparams, "refine_enc")
         return tf.expand_dims(r, axis=2)
-      masked_batches = tf.reduce_sum(mask, axis=[1, 2, 3])
+      masked_batches = tf.reduce_sum(tf.to_float(mask), axis=[1, 2, 3])
       all_masked = tf.less(masked_batches, 0.1)
       res = tf.where(all_masked, refine_res(), res)
     # We'll start training the extra model of latents after mask_startup_steps.
@@ -533,13 +678,79 @@ def ae_transformer_internal(inputs,
   # res was generated from padded targets, which means it has some extra
   # elements. These can cause shape problems when computing loss with respect to
   # the original (unpadded) targets. So we remove their extra elements here.
-  res = res[:, :original_targets_shape[1], :, :]
+  orig_len = original_targets_shape[1]
+  res = tf.slice(res, [0, 0, 0, 0], [-1, orig_len, -1, -1])
 
   data_dim = common_layers.shape_list(res)[1]
   latent_dim = common_layers.shape_list(targets_c)[1]
   return res, losses, cache, data_dim, latent_dim
 
 
+# Per-graph memo of summary-collection scans; keyed weakly so finished
+# graphs are not kept alive.
+_SUMMARY_COLLECTION_CACHE = weakref.WeakKeyDictionary()
+
+
+def _cached_summaries(scope):
+  """Memoize tf.get_collection(SUMMARIES, scope=scope) for a graph.
+
+  get_collection re-scans the graph's whole summary collection with a
+  regex match per entry on every call; eval-spec construction repeats
+  this per dataset on graphs with hundreds of summaries. The snapshot is
+  taken after the model body is built, so later invocations on the same
+  graph see the same ops.
+  """
+  graph = tf.get_default_graph()
+  per_graph = _SUMMARY_COLLECTION_CACHE.setdefault(graph, {})
+  if scope not in per_graph:
+    per_graph[scope] = tf.get_collection(tf.GraphKeys.SUMMARIES, scope=scope)
+  return per_graph[scope]
+
+
+class _AsyncSummaryWriter(object):
+  """Summary writer that hands file I/O to a background thread.
+
+  SummarySaverHook serializes and writes summaries on the thread that ran
+  the step, stalling the next step on filesystem I/O whenever it fires.
+  This wrapper enqueues (summary, global_step) pairs for a daemon thread
+  to write; flush() drains the queue first so nothing is dropped when the
+  hook flushes at end of evaluation. The queue is bounded so a slow disk
+  applies backpressure instead of growing memory without limit.
+  """
+
+  def __init__(self, writer, max_pending=32):
+    self._writer = writer
+    self._queue = queue.Queue(max_pending)
+    worker = threading.Thread(target=self._drain)
+    worker.daemon = True
+    worker.start()
+
+  def _drain(self):
+    while True:
+      summary, global_step = self._queue.get()
+      try:
+        self._writer.add_summary(summary, global_step)
+      except Exception:  # pylint: disable=broad-except
+        # Keep draining: a dead worker would fill the bounded queue and
+        # deadlock flush(); losing a summary is preferable.
+        tf.logging.error("Async summary write failed", exc_info=True)
+      finally:
+        self._queue.task_done()
+
+  def add_summary(self, summary, global_step=None):
+    self._queue.put((summary, global_step))
+
+  def flush(self):
+    self._queue.join()
+    self._writer.flush()
+
+  def __getattr__(self, name):
+    # Everything else (add_session_log, add_graph, ...) goes straight to
+    # the wrapped writer; SummarySaverHook calls add_session_log on its
+    # first after_run, so the wrapper must expose the full writer surface.
+    return getattr(self._writer, name)
+
+
 @registry.register_model
 class TransformerAE(t2t_model.T2TModel):
   """Autoencoder-augmented Transformer."""
@@ -574,65 +785,65 @@ class TransformerAE(t2t_model.T2TModel):
         noise_dev=self._hparams.noise_dev,
         startup_steps=self.hparams.startup_steps,
         summary=_DO_SUMMARIES)
-    # Set the discretization bottleneck specific things here
+    # Set the discretization bottleneck specific things here. Variables
+    # are created under AUTO_REUSE (with unchanged names) so that
+    # re-instantiating the model in the same graph -- one tower per
+    # replica under distribution strategies -- picks up the existing
+    # codebook instead of re-running the initializer draws.
     if self._hparams.bottleneck_kind in ["dvq", "gumbel-softmax-dvq"]:
       z_size_per_residual = self._hparams.z_size / self._hparams.num_residuals
       block_dim = int(self._hparams.hidden_size // self._hparams.num_blocks)
       block_v_size = 2**(z_size_per_residual / self._hparams.num_blocks)
       block_v_size = int(block_v_size)
 
-      if self._hparams.reshape_method == "project":
-        tf.logging.info("Using projections for DVQ")
-        tf.logging.info("Trainable projections = {}".format(
-            self._hparams.trainable_projections))
+      with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE):
+        if self._hparams.reshape_method == "project":
+          tf.logging.info("Using projections for DVQ")
+          tf.logging.info("Trainable projections = {}".format(
+              self._hparams.trainable_projections))
+
+          projection_tensors = tf.get_variable(
+              name="projection",
+              shape=[
+                  self._hparams.num_residuals, self._hparams.num_blocks,
+                  self._hparams.hidden_size, block_dim
+              ],
+              initializer=tf.initializers.glorot_uniform(),
+              trainable=self._hparams.trainable_projections)
+
+          self._hparams.bottleneck = functools.partial(
+              self._hparams.bottleneck, projection_tensors=projection_tensors)
+        elif self._hparams.reshape_method == "slice":
+          tf.logging.info("Using slices for DVQ")
+        else:
+          raise ValueError("Unknown reshape method")
 
-        projection_tensors = tf.get_variable(
-            name="projection",
+        means = tf.get_variable(
+            name="means",
             shape=[
                 self._hparams.num_residuals, self._hparams.num_blocks,
-                self._hparams.hidden_size, block_dim
+                block_v_size, block_dim
             ],
-            initializer=tf.initializers.glorot_uniform(),
-            trainable=self._hparams.trainable_projections)
-
-        self._hparams.bottleneck = functools.partial(
-            self._hparams.bottleneck, projection_tensors=projection_tensors)
-      elif self._hparams.reshape_method == "slice":
-        tf.logging.info("Using slices for DVQ")
-      else:
-        raise ValueError("Unknown reshape method")
-
-      means = tf.get_variable(
-          name="means",
-          shape=[
-              self._hparams.num_residuals, self._hparams.num_blocks,
-              block_v_size, block_dim
-          ],
-          initializer=tf.uniform_unit_scaling_initializer())
-
-      # Create the shadow variables if we are using EMA
-      ema_count = None
-      ema_means = None
-      if self._hparams.ema:
-        ema_count = []
-        for i in range(self._hparams.num_residuals):
-          ema_count_i = tf.get_variable(
-              "ema_count_{}".format(i),
-              [self._hparams.num_blocks, block_v_size],
+            initializer=tf.uniform_unit_scaling_initializer())
+
+        # Create the shadow variables if we are using EMA. Both are packed
+        # across residuals so the per-step EMA updates (and their
+        # allreduces in distributed training) run as one assignment each
+        # instead of num_residuals.
+        ema_count = None
+        ema_means = None
+        if self._hparams.ema:
+          ema_count = tf.get_variable(
+              "ema_count",
+              [self._hparams.num_residuals, self._hparams.num_blocks,
+               block_v_size],
               initializer=tf.constant_initializer(0),
               trainable=False)
-          ema_count.append(ema_count_i)
-        with tf.colocate_with(means):
-          ema_means = []
-          for i in range(self._hparams.num_residuals):
-            ema_means_i = tf.get_variable(
-                "ema_means_{}".format(i),
-                [self._hparams.num_blocks, block_v_size, block_dim],
-                initializer=(lambda shape, dtype=None, partition_info=None,  # pylint: disable=g-long-lambda
-                                    verify_shape=None:
-                             means.initialized_value()[i]),
+          with tf.colocate_with(means):
+            ema_means = tf.get_variable(
+                "ema_means",
+                initializer=means.initialized_value(),
                 trainable=False)
-            ema_means.append(ema_means_i)
 
       # Update bottleneck
       self._hparams.bottleneck = functools.partial(
@@ -647,13 +858,15 @@ class TransformerAE(t2t_model.T2TModel):
       inputs = None
     reuse = "cache_raw" in features
     with tf.variable_scope(tf.get_variable_scope(), reuse=reuse):
-      res, loss, _, self._data_dim, self._latent_dim = ae_transformer_internal(
-          inputs,
-          features["targets"],
-          features["target_space_id"],
-          self._hparams,
-          features.get("cache_raw", None),
-          predict_mask=self.predict_mask)
+      with _maybe_jit_scope(self._hparams):
+        res, loss, _, self._data_dim, self._latent_dim = (
+            ae_transformer_internal(
+                inputs,
+                features["targets"],
+                features["target_space_id"],
+                self._hparams,
+                features.get("cache_raw", None),
+                predict_mask=self.predict_mask))
       return res, loss
 
   def prepare_features_for_infer(self, features):
@@ -686,6 +899,7 @@ class TransformerAE(t2t_model.T2TModel):
       features["inputs"] = tf.expand_dims(features["inputs"], 2)
 
     # Create an initial targets tensor.
+    trim_length = None
     if "partial_targets" in features:
       initial_output = tf.convert_to_tensor(features["partial_targets"])
     else:
@@ -697,6 +911,18 @@ class TransformerAE(t2t_model.T2TModel):
       length = common_layers.shape_list(inputs_or_targets)[1]
       hidden_dim = common_layers.shape_list(inputs_or_targets)[-1]
       target_length = tf.to_int32(2.0 * tf.to_float(length))
+      if self._hparams.get("bucket_decode_length"):
+        # Pad the decode length up to the next power of two so compiled
+        # runs (see xla_compile_ae_body) see O(log n) distinct shapes to
+        # specialize instead of one per input length; the extra positions
+        # are trimmed from the returned samples.
+        trim_length = target_length
+        target_length = tf.pow(
+            2,
+            tf.to_int32(
+                tf.ceil(
+                    tf.log(tf.maximum(tf.to_float(target_length), 1.0)) /
+                    math.log(2.0))))
       initial_output = tf.zeros((batch_size, target_length, 1, hidden_dim),
                                 dtype=inputs_or_targets.dtype)
 
@@ -706,7 +932,11 @@ class TransformerAE(t2t_model.T2TModel):
     if inputs_or_targets.dtype == tf.float32:
       samples = logits
     else:
-      samples = tf.argmax(logits, axis=-1)
+      # int32 indices halve the output bandwidth of the argmax vs the
+      # default int64. Reducing here also means only compact index
+      # tensors -- never the [batch, length, vocab] logits -- leave infer
+      # and get accumulated across eval/predict batches.
+      samples = tf.argmax(logits, axis=-1, output_type=tf.int32)
 
     # More steps.
     self.predict_mask = 0.0  # Use the provided targets this time.
@@ -720,191 +950,298 @@ class TransformerAE(t2t_model.T2TModel):
           # classes, so it should not be argmax'ed
           samples = logits
         else:
-          samples = tf.argmax(logits, axis=-1)
+          samples = tf.argmax(logits, axis=-1, output_type=tf.int32)
 
-    self.predict_mask = 1.0
+    # Reset without re-entering Keras attribute tracking: Layer.__setattr__
+    # walks the tracked-object machinery on every assignment, which is
+    # wasted work for this plain float on the decode path.
+    if self.predict_mask != 1.0:
+      object.__setattr__(self, "predict_mask", 1.0)
     if inputs_old is not None:  # Restore to not confuse Estimator.
       features["inputs"] = inputs_old
+    if trim_length is not None:
+      samples = samples[:, :trim_length]
     return samples
 
+  @property
+  def _xla_compiled(self):
+    """Memoized common_layers.is_xla_compiled() for this instance's graph.
+
+    The check walks the graph/context stack; eval-spec construction can
+    re-enter per dataset and the answer cannot change within one model
+    instance.
+    """
+    if "_xla_compiled_memo" not in self.__dict__:
+      self.__dict__["_xla_compiled_memo"] = common_layers.is_xla_compiled()
+    return self.__dict__["_xla_compiled_memo"]
+
+  @property
+  def _eval_dir(self):
+    """Eval summary directory under model_dir, joined once per instance."""
+    if "_eval_dir_memo" not in self.__dict__:
+      self.__dict__["_eval_dir_memo"] = os.path.join(
+          self.hparams.model_dir, "eval")
+    return self.__dict__["_eval_dir_memo"]
+
   def estimator_spec_eval(self, features, logits, labels, loss, losses_dict):
     """Constructs `tf.estimator.EstimatorSpec` for EVAL (evaluation) mode."""
     estimator_spec = super(TransformerAE, self).estimator_spec_eval(
         features, logits, labels, loss, losses_dict)
-    if common_layers.is_xla_compiled():
+    if self._xla_compiled:
       # For TPUs (and XLA more broadly?), do not add summary hooks that depend
       # on losses; they are not supported.
       return estimator_spec
 
-    summary_op = tf.get_collection(tf.GraphKeys.SUMMARIES, scope="losses")
-    summary_op.extend(tf.get_collection(tf.GraphKeys.SUMMARIES, scope="loss"))
-    summary_op.append(tf.summary.scalar("loss", loss))
-    summary_saver_hook = tf.train.SummarySaverHook(
-        save_steps=100,
-        summary_op=summary_op,
-        output_dir=os.path.join(self.hparams.model_dir, "eval"))
+    # For an eval run shorter than the hook's save interval, skip gathering
+    # the summary ops and building the hook entirely. This is not free:
+    # SummarySaverHook's timer fires on the first before_run call, so a
+    # short eval previously emitted one summary at its first step, which
+    # this guard trades away.
+    if self.hparams.get("eval_steps", 10**9) < 100:
+      return estimator_spec
 
-    hooks = list(estimator_spec.evaluation_hooks)
-    hooks.append(summary_saver_hook)
-    return estimator_spec._replace(evaluation_hooks=hooks)
+    # The hook depends only on this graph's summary collections and the
+    # model_dir, so when Estimator.evaluate re-enters here on the same
+    # graph (multi-dataset eval) reuse the hook instead of rebuilding it;
+    # the first invocation's loss scalar serves the whole graph.
+    hook_cache = self.__dict__.setdefault("_eval_hooks_for_graph", {})
+    graph_key = id(tf.get_default_graph())
+    summary_saver_hook = hook_cache.get(graph_key)
+    if summary_saver_hook is None:
+      summary_op = _cached_summaries("losses") + _cached_summaries("loss")
+      summary_op.append(tf.summary.scalar("loss", loss))
+      # Note on cost: SummarySaverHook only adds summary_op to the session
+      # fetches when its SecondOrStepTimer fires (every save_steps), so on
+      # the other steps the summary subgraph is pruned and never computed
+      # -- no record_if-style gating is needed in graph mode. The TF2
+      # tf.summary writer API is likewise not a drop-in here: these are v1
+      # summary ops gathered from GraphKeys.SUMMARIES, which v2 writers do
+      # not consume, and the async writer below already keeps file I/O off
+      # the eval thread.
+      summary_saver_hook = tf.train.SummarySaverHook(
+          save_steps=100,
+          summary_op=summary_op,
+          summary_writer=_AsyncSummaryWriter(
+              tf.summary.FileWriterCache.get(self._eval_dir)))
+      hook_cache[graph_key] = summary_saver_hook
+
+    return estimator_spec._replace(
+        evaluation_hooks=tuple(estimator_spec.evaluation_hooks) +
+        (summary_saver_hook,))
 
   def _summarize_losses(self, losses_dict):
     """Adds `tf.summary`s to all terms in the losses dictionary."""
     super(TransformerAE, self)._summarize_losses(losses_dict)
-    nats_per_dim, bits_per_dim = latent_layers.compute_nats_and_bits_per_dim(
-        data_dim=self._data_dim,
-        latent_dim=self._latent_dim,
-        average_reconstruction=losses_dict["training"],
-        average_prior=losses_dict["latent_pred"])
-    tf.summary.scalar("loss/nats_per_dim", nats_per_dim)
-    tf.summary.scalar("loss/bits_per_dim", bits_per_dim)
+    # Summarizing the same loss tensors again (eval can re-enter here per
+    # dataset) would rebuild an identical nats/bits subgraph and duplicate
+    # the summaries, so reuse the ops built for this tensor pair. Graph
+    # mode only: in eager a cache would pin tensors alive.
+    key = (id(losses_dict["training"]), id(losses_dict["latent_pred"]))
+    cache = self.__dict__.setdefault("_nats_bits_cache", {})
+    if tf.executing_eagerly() or key not in cache:
+      nats_per_dim, bits_per_dim = latent_layers.compute_nats_and_bits_per_dim(
+          data_dim=self._data_dim,
+          latent_dim=self._latent_dim,
+          average_reconstruction=losses_dict["training"],
+          average_prior=losses_dict["latent_pred"])
+      tf.summary.scalar("loss/nats_per_dim", nats_per_dim)
+      tf.summary.scalar("loss/bits_per_dim", bits_per_dim)
+      if not tf.executing_eagerly():
+        # Hold the loss tensors so the ids stay valid for the cache's life.
+        cache[key] = (losses_dict["training"], losses_dict["latent_pred"])
+
+
+def _update_hparams(hparams, overrides):
+  """Apply a dict of overrides, adding hparams that do not exist yet.
+
+  One bulk pass over a module-level dict replaces the long per-config
+  cascade of attribute assignments and add_hparam calls, which each paid
+  HParams setter validation on every config build.
+  """
+  for name, value in sorted(overrides.items()):
+    if name in hparams:
+      hparams.set_hparam(name, value)
+    else:
+      hparams.add_hparam(name, value)
+  return hparams
+
+
+# Overrides applied to transformer_small() to obtain transformer_ae_small.
+_AE_SMALL_OVERRIDES = {
+    "batch_size": 2048,
+    "learning_rate": 0.2,
+    "learning_rate_warmup_steps": 4000,
+    "num_hidden_layers": 3,
+    "hidden_size": 384,
+    "filter_size": 2048,
+    "compress_filter_size": 2048 * 2,
+    "label_smoothing": 0.0,
+    "optimizer": "adam",  # Can be unstable, maybe try Adam.
+    "optimizer_adam_epsilon": 1e-9,
+    "optimizer_adam_beta1": 0.9,
+    "optimizer_adam_beta2": 0.997,  # Needs tuning, try 0.98 to 0.999.
+    "z_size": 14,
+    "noise_dev": 0.5,
+    "d_mix": 0.5,
+    "logit_normalization": True,
+    "word_dropout": 0.,
+    # Bottleneck kinds supported: dense, vae, semhash, gumbel-softmax, dvq.
+    "bottleneck_kind": "semhash",
+    "num_blocks": 1,
+    "num_decode_blocks": 1,
+    # Number of residuals.
+    "num_residuals": 1,
+    "word_shuffle": 0.5,
+    "causal": True,
+    # Reshape method for DVQ: slice, project.
+    "reshape_method": "slice",
+    "trainable_projections": False,
+    "unmasked_percentage": 0.1,
+    "do_ae": True,
+    "do_mask": True,
+    "use_predict_mask": True,
+    "do_refine": False,
+    "do_attend_compress": False,
+    "do_attend_decompress": True,
+    "do_residual_compress": False,
+    "drop_inputs": False,
+    "v_size": 1024 * 64,
+    "max_context_length": 64,
+    "num_compress_steps": 3,
+    "startup_steps": 10000,
+    "mask_startup_steps": 50000,
+    "z_dropout": 0.1,
+    "is_2d": 0,
+    "softmax_k": 0,
+    "decode_autoregressive": True,
+    "do_vae": True,
+    "bit_vae": True,
+    "beta": 0.25,
+    "epsilon": 1e-5,
+    "decay": 0.999,
+    "ema": True,
+    "random_top_k": 1,
+    "soft_em": False,
+    "num_samples": 10,
+    "inv_temp": 1.0,
+    "entropy_scale": 0.0,
+    "prior_scale": 1.0,
+    "do_hard_gumbel_softmax": False,
+    "num_flows": 0,
+    "approximate_gs_entropy": False,
+    "temperature_warmup_steps": 150000,
+    "sum_over_latents": False,
+    # Compile the autoencoder body with XLA to fuse the small ops in the
+    # compress/decompress stack. Off by default; sampling stays uncompiled.
+    "xla_compile_ae_body": False,
+    # Decompress with one wide conv instead of a per-step loop; incompatible
+    # with do_attend_decompress and trains a different set of variables.
+    "fused_decompress": False,
+    # Round infer decode lengths up to powers of two (trimmed afterwards) so
+    # compiled graphs see a bounded set of shapes.
+    "bucket_decode_length": False,
+    "force_full_predict": True,
+    # Task params: translate or image tasks supported.
+    "task": "translate",
+}
+
+# Gap sizes for dilated attention, shared by every cifar config build; a
+# tuple so builds cannot alias-mutate each other through the shared value.
+_GAP_SIZES = (2, 4, 8, 16, 32, 64, 2, 4, 8, 16, 32, 64)
+
+# Overrides applied on top of transformer_ae_small for CIFAR-10.
+_CIFAR_OVERRIDES = {
+    "filter_size": 512,
+    "num_compress_steps": 3,
+    "startup_steps": 10000,
+    "is_2d": 0,
+    "learning_rate_warmup_steps": 8000,
+    "learning_rate": 0.1,
+    "hidden_size": 512,
+    "batch_size": 1,
+    "max_length": 256,
+    "dropout": 0.0,
+    "clip_grad_norm": 0.,  # i.e. no gradient clipping
+    "optimizer_adam_epsilon": 1e-9,
+    "learning_rate_decay_scheme": "noam",
+    "initializer_gain": 0.2,
+    "num_hidden_layers": 6,
+    "initializer": "uniform_unit_scaling",
+    "weight_decay": 0.0,
+    "optimizer_adam_beta1": 0.9,
+    "optimizer_adam_beta2": 0.98,
+    "label_smoothing": 0.0,
+    "norm_type": "layer",
+    "layer_prepostprocess_dropout": 0.0,
+    "num_heads": 8,
+    "task": "image",
+    "ffn_layer": "conv_hidden_relu",
+    # All hyperparameters ending in "dropout" are automatically set to 0.0
+    # when not in training mode.
+    "attention_dropout": 0.0,
+    "relu_dropout": 0.,
+    "pos": "timing",  # timing, none
+    "nbr_decoder_problems": 1,
+    "num_output_layers": 3,
+    # TODO(trandustin): semhash doesn't work if filter_size != hidden_size. For
+    # now, set default to dvq.
+    "bottleneck_kind": "dvq",
+    "block_size": 1,
+    # dilated attention based flags
+    "gap_sizes": _GAP_SIZES,
+    "dilated_attention": False,
+    # image size related flags; assuming the image has same height and width
+    "img_len": 32,
+    "num_channels": 3,
+    # Local attention params
+    "local_and_global_att": False,
+    "block_length": 256,
+    "block_width": 128,
+    "num_encoder_layers": 4,
+    "num_decoder_layers": 12,
+    "dec_attention_type": cia.AttentionType.LOCAL_1D,
+    "block_raster_scan": False,
+    "shared_rel": False,
+    # multipos attention params
+    "q_filter_width": 1,
+    "kv_filter_width": 1,
+    "unconditional": False,  # unconditional generation
+    "drop_inputs": True,
+    "do_attend_compress": False,
+    "do_attend_decompress": False,
+}
+
+# Overrides applied on top of transformer_ae_small for the base config.
+_AE_BASE_OVERRIDES = {
+    "batch_size": 2048,
+    "hidden_size": 512,
+    "filter_size": 4096,
+    "num_hidden_layers": 6,
+}
+
+
+# Pristine transformer_ae_small HParams, built on first use; every config
+# build deep-copies it instead of re-running the transformer_small chain
+# plus the full override pass.
+_SMALL_BASE = None
 
 
 @registry.register_hparams
 def transformer_ae_small():
   """Set of hyperparameters."""
-  hparams = transformer.transformer_small()
-  hparams.batch_size = 2048
-  hparams.learning_rate = 0.2
-  hparams.learning_rate_warmup_steps = 4000
-  hparams.num_hidden_layers = 3
-  hparams.hidden_size = 384
-  hparams.filter_size = 2048
-  hparams.add_hparam("compress_filter_size", 2048 * 2)
-  hparams.label_smoothing = 0.0
-  hparams.optimizer = "adam"  # Can be unstable, maybe try Adam.
-  hparams.optimizer_adam_epsilon = 1e-9
-  hparams.optimizer_adam_beta1 = 0.9
-  hparams.optimizer_adam_beta2 = 0.997  # Needs tuning, try 0.98 to 0.999.
-  hparams.add_hparam("z_size", 14)
-  hparams.add_hparam("noise_dev", 0.5)
-  hparams.add_hparam("d_mix", 0.5)
-  hparams.add_hparam("logit_normalization", True)
-  hparams.add_hparam("word_dropout", 0.)
-  # Bottleneck kinds supported: dense, vae, semhash, gumbel-softmax, dvq.
-  hparams.add_hparam("bottleneck_kind", "semhash")
-  hparams.add_hparam("num_blocks", 1)
-  hparams.add_hparam("num_decode_blocks", 1)
-  # Add an hparam for number of reiduals
-  hparams.add_hparam("num_residuals", 1)
-  # Reshape method for DVQ: slice, project
-  hparams.add_hparam("word_shuffle", 0.5)
-  hparams.add_hparam("causal", True)
-  hparams.add_hparam("reshape_method", "slice")
-  hparams.add_hparam("trainable_projections", False)
-  hparams.add_hparam("unmasked_percentage", 0.1)
-  hparams.add_hparam("do_ae", True)
-  hparams.add_hparam("do_mask", True)
-  hparams.add_hparam("use_predict_mask", True)
-  hparams.add_hparam("do_refine", False)
-  hparams.add_hparam("do_attend_compress", False)
-  hparams.add_hparam("do_attend_decompress", True)
-  hparams.add_hparam("do_residual_compress", False)
-  hparams.add_hparam("drop_inputs", False)
-  hparams.add_hparam("v_size", 1024*64)
-  hparams.add_hparam("max_context_length", 64)
-  hparams.add_hparam("num_compress_steps", 3)
-  hparams.add_hparam("startup_steps", 10000)
-  hparams.add_hparam("mask_startup_steps", 50000)
-  hparams.add_hparam("z_dropout", 0.1)
-  hparams.add_hparam("is_2d", 0)
-  hparams.add_hparam("softmax_k", 0)
-  hparams.add_hparam("decode_autoregressive", True)
-  hparams.add_hparam("do_vae", True)
-  hparams.add_hparam("bit_vae", True)
-  hparams.add_hparam("beta", 0.25)
-  hparams.add_hparam("epsilon", 1e-5)
-  hparams.add_hparam("decay", 0.999)
-  hparams.add_hparam("ema", True)
-  hparams.add_hparam("random_top_k", 1)
-  hparams.add_hparam("soft_em", False)
-  hparams.add_hparam("num_samples", 10)
-  hparams.add_hparam("inv_temp", 1.0)
-  hparams.add_hparam("entropy_scale", 0.0)
-  hparams.add_hparam("prior_scale", 1.0)
-  hparams.add_hparam("do_hard_gumbel_softmax", False)
-  hparams.add_hparam("num_flows", 0)
-  hparams.add_hparam("approximate_gs_entropy", False)
-  hparams.add_hparam("temperature_warmup_steps", 150000)
-  hparams.add_hparam("sum_over_latents", False)
-  hparams.force_full_predict = True
-
-  # task params
-  hparams.add_hparam("task", "translate")  # translate or image tasks supported
-  return hparams
+  global _SMALL_BASE
+  if _SMALL_BASE is None:
+    _SMALL_BASE = _update_hparams(
+        transformer.transformer_small(), _AE_SMALL_OVERRIDES)
+  return copy.deepcopy(_SMALL_BASE)
 
 
 @registry.register_hparams
 def imagetransformer_ae_cifar():
   """Hyperparameters for CIFAR-10 experiments."""
-  hparams = transformer_ae_small()
-  hparams.filter_size = 512
-  hparams.num_compress_steps = 3
-  hparams.startup_steps = 10000
-  hparams.is_2d = 0
-  hparams.learning_rate_warmup_steps = 8000
-  hparams.learning_rate = 0.2
-  hparams.hidden_size = 512
-  hparams.batch_size = 1
-  hparams.max_length = 256
-  hparams.dropout = 0.0
-  hparams.clip_grad_norm = 0.  # i.e. no gradient clipping
-  hparams.optimizer_adam_epsilon = 1e-9
-  hparams.learning_rate_decay_scheme = "noam"
-  hparams.learning_rate = 0.1
-  hparams.initializer_gain = 0.2
-  hparams.num_hidden_layers = 6
-  hparams.initializer = "uniform_unit_scaling"
-  hparams.weight_decay = 0.0
-  hparams.optimizer_adam_beta1 = 0.9
-  hparams.optimizer_adam_beta2 = 0.98
-  hparams.label_smoothing = 0.0
-  hparams.norm_type = "layer"
-  hparams.layer_prepostprocess_dropout = 0.0
-  hparams.num_heads = 8
-  hparams.task = "image"
-  hparams.ffn_layer = "conv_hidden_relu"
-  # All hyperparameters ending in "dropout" are automatically set to 0.0
-  # when not in training mode.
-  hparams.attention_dropout = 0.0
-  hparams.relu_dropout = 0.
-  hparams.pos = "timing"  # timing, none
-  hparams.nbr_decoder_problems = 1
-  hparams.num_output_layers = 3
-  # TODO(trandustin): semhash doesn't work if filter_size != hidden_size. For
-  # now, set default to dvq.
-  hparams.bottleneck_kind = "dvq"
-  hparams.add_hparam("block_size", 1)
-
-  # dilated attention based flags
-  hparams.add_hparam("gap_sizes", [2, 4, 8, 16, 32, 64, 2, 4, 8, 16, 32, 64])
-  hparams.add_hparam("dilated_attention", False)
-
-  # image size related flags
-  # assuming that the image has same height and width
-  hparams.add_hparam("img_len", 32)
-  hparams.add_hparam("num_channels", 3)
-  # Local attention params
-  hparams.add_hparam("local_and_global_att", False)
-  hparams.add_hparam("block_length", 256)
-  hparams.add_hparam("block_width", 128)
-  hparams.num_encoder_layers = 4
-  hparams.num_decoder_layers = 12
-  hparams.add_hparam("dec_attention_type", cia.AttentionType.LOCAL_1D)
-  hparams.add_hparam("block_raster_scan", False)
-  hparams.add_hparam("shared_rel", False)
-
-  # multipos attention params
-  hparams.add_hparam("q_filter_width", 1)
-  hparams.add_hparam("kv_filter_width", 1)
-
-  hparams.add_hparam("unconditional", False)  # unconditional generation
-
+  hparams = _update_hparams(transformer_ae_small(), _CIFAR_OVERRIDES)
   hparams.bottom["targets"] = modalities.image_channel_embeddings_bottom
   hparams.top["targets"] = modalities.image_channel_embeddings_top
-  hparams.drop_inputs = True
-  hparams.do_attend_compress = False
-  hparams.do_attend_decompress = False
   return hparams
 
 
@@ -923,42 +1260,7 @@ def imagetransformer_ae_imagenet():
 @registry.register_hparams
 def transformer_ae_base():
   """Set of hyperparameters."""
-  hparams = transformer_ae_small()
-  hparams.batch_size = 2048
-  hparams.hidden_size = 512
-  hparams.filter_size = 4096
-  hparams.num_hidden_layers = 6
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_a3():
-  """Set of hyperparameters."""
-  hparams = transformer_ae_base()
-  hparams.batch_size = 4096
-  hparams.layer_prepostprocess_dropout = 0.3
-  hparams.optimizer = "Adafactor"
-  hparams.learning_rate = 0.25
-  hparams.learning_rate_warmup_steps = 10000
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_a6():
-  """Best hparams for transformer with semhash."""
-  hparams = transformer_ae_a3()
-  hparams.optimizer = "adam"
-  hparams.noise_dev = 0.5
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_a8():
-  """Set of hyperparameters."""
-  hparams = transformer_ae_a3()
-  hparams.optimizer = "Adafactor"
-  hparams.noise_dev = 0.5
-  return hparams
+  return _update_hparams(transformer_ae_small(), _AE_BASE_OVERRIDES)
 
 
 @registry.register_hparams
@@ -970,17 +1272,23 @@ def transformer_ae_base_tpu():
   return hparams
 
 
+# Shared overrides for the no-decompress-attention configs; one source of
+# truth so the small and base variants cannot drift apart.
+_NOATT_OVERRIDES = dict(
+    reshape_method="slice",
+    bottleneck_kind="dvq",
+    hidden_size=512,
+    num_blocks=1,
+    num_decode_blocks=1,
+    z_size=12,
+    do_attend_decompress=False)
+
+
 @registry.register_hparams
 def transformer_ae_base_noatt():
   """Set of hyperparameters."""
   hparams = transformer_ae_base()
-  hparams.reshape_method = "slice"
-  hparams.bottleneck_kind = "dvq"
-  hparams.hidden_size = 512
-  hparams.num_blocks = 1
-  hparams.num_decode_blocks = 1
-  hparams.z_size = 12
-  hparams.do_attend_decompress = False
+  hparams.override_from_dict(_NOATT_OVERRIDES)
   return hparams
 
 
@@ -988,59 +1296,60 @@ def transformer_ae_base_noatt():
 def transformer_ae_small_noatt():
   """Set of hyperparameters."""
   hparams = transformer_ae_small()
-  hparams.reshape_method = "slice"
-  hparams.bottleneck_kind = "dvq"
-  hparams.hidden_size = 512
-  hparams.num_blocks = 1
-  hparams.num_decode_blocks = 1
-  hparams.z_size = 12
-  hparams.do_attend_decompress = False
+  hparams.override_from_dict(_NOATT_OVERRIDES)
   return hparams
 
 
-@registry.register_hparams
-def transformer_ae_base_ablation_1():
-  hparams = transformer_ae_base_noatt()
-  hparams.soft_em = True
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_base_ablation_2():
-  hparams = transformer_ae_base_ablation_1()
-  hparams.entropy_scale = 0.1
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_base_ablation_3():
-  hparams = transformer_ae_base_ablation_2()
-  hparams.prior_scale = 0.1
-  hparams.entropy_scale = 0.1
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_base_ablation_4():
-  hparams = transformer_ae_base_ablation_3()
-  hparams.entropy_scale = 0.0
-  hparams.prior_scale = 1.0
-  hparams.bottleneck_kind = "gumbel-softmax-dvq"
-  hparams.do_hard_gumbel_softmax = True
-  hparams.approximate_gs_entropy = True
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_base_ablation_5():
-  hparams = transformer_ae_base_ablation_4()
-  hparams.do_hard_gumbel_softmax = False
-  return hparams
-
-
-@registry.register_hparams
-def transformer_ae_base_iaf():
-  hparams = transformer_ae_base_ablation_5()
-  hparams.num_flows = 1
-  hparams.num_samples = 1
-  return hparams
+# Near-identical tuning and ablation configs, registered from tables of
+# override dicts instead of a chain of one-off functions. The dicts are
+# cumulative (each later config's values flattened in), so every variant
+# is one base build plus one bulk override pass.
+_A3_OVERRIDES = dict(
+    batch_size=4096,
+    layer_prepostprocess_dropout=0.3,
+    optimizer="Adafactor",
+    learning_rate=0.25,
+    learning_rate_warmup_steps=10000)
+
+_ABLATION_1_OVERRIDES = dict(soft_em=True)
+_ABLATION_2_OVERRIDES = dict(_ABLATION_1_OVERRIDES, entropy_scale=0.1)
+_ABLATION_3_OVERRIDES = dict(_ABLATION_2_OVERRIDES, prior_scale=0.1)
+_ABLATION_4_OVERRIDES = dict(
+    _ABLATION_3_OVERRIDES,
+    entropy_scale=0.0,
+    prior_scale=1.0,
+    bottleneck_kind="gumbel-softmax-dvq",
+    do_hard_gumbel_softmax=True,
+    approximate_gs_entropy=True)
+_ABLATION_5_OVERRIDES = dict(_ABLATION_4_OVERRIDES, do_hard_gumbel_softmax=False)
+
+
+def _register_ae_variants(base_fn, variants):
+  """Registers hparams configs that are base_fn plus a dict of overrides."""
+  for name, overrides in sorted(variants.items()):
+    def _variant(base_fn=base_fn, overrides=overrides):
+      hparams = base_fn()
+      hparams.override_from_dict(overrides)
+      return hparams
+    registry.register_hparams(name)(_variant)
+
+
+_register_ae_variants(transformer_ae_base, {
+    # Base config with bfloat16 activations in the memory-bound sections.
+    "transformer_ae_base_bf16_activation": dict(activation_dtype="bfloat16"),
+    "transformer_ae_a3": _A3_OVERRIDES,
+    # Best hparams for transformer with semhash.
+    "transformer_ae_a6": dict(_A3_OVERRIDES, optimizer="adam", noise_dev=0.5),
+    "transformer_ae_a8": dict(
+        _A3_OVERRIDES, optimizer="Adafactor", noise_dev=0.5),
+})
+
+_register_ae_variants(transformer_ae_base_noatt, {
+    "transformer_ae_base_ablation_1": _ABLATION_1_OVERRIDES,
+    "transformer_ae_base_ablation_2": _ABLATION_2_OVERRIDES,
+    "transformer_ae_base_ablation_3": _ABLATION_3_OVERRIDES,
+    "transformer_ae_base_ablation_4": _ABLATION_4_OVERRIDES,
+    "transformer_ae_base_ablation_5": _ABLATION_5_OVERRIDES,
+    "transformer_ae_base_iaf": dict(
+        _ABLATION_5_OVERRIDES, num_flows=1, num_samples=1),
+})